@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import chunker
+import matcher
+from matcher import BLOCK_SIZE
+
+# the most places recorded in the index for any one block. Every place a block can be
+# found is checked when it is matched, so in data that repeats with a short period,
+# where the same block occurs at many places, recording all of them would make
+# matching take time proportional to the number of repeats
+MAX_BLOCK_PLACES = 8
+
+class BlockIndex:
+    """
+    A BlockIndex object records the contents of every file that has been uploaded, so
+    that sections of new files can be matched against them. It contains:
+
+        blocks: maps the fingerprint of each aligned BLOCK_SIZE block to a list of up
+                to MAX_BLOCK_PLACES (file, offset) pairs where that block can be found
+        chunks: maps the digest of each content-defined chunk to a
+                (file, offset, length) tuple where that chunk can be found
+        keys: the fingerprints in `blocks`, as returned by matcher.prepare_keys. This
+              is kept up to date as files are added, rather than being rebuilt from
+              `blocks` every time a file is searched
+        contents: maps each file to its contents as they were when it was added, so
+                  that matches are checked against the data the server received. The
+                  contents are read into memory rather than memory-mapped, as the file
+                  may be changed or truncated afterwards, and keeping a map open would
+                  also keep a file descriptor open for every file
+
+    Files are added with BlockIndex.add.
+    """
+
+    def __init__(self):
+        self.blocks = {}
+        self.keys = matcher.prepare_keys(self.blocks)
+        self.chunks = {}
+        self.contents = {}
+
+    def add(self, file, file_size=None):
+        "add every aligned block and every content-defined chunk in `file` to the index"
+        with file.open("rb") as f:
+            # only the first `file_size` bytes were uploaded, if the file has grown since
+            data = f.read() if file_size is None else f.read(file_size)
+        self.contents[file] = data
+
+        new_hashes = []
+        prev_hash = None
+        for k, h in enumerate(matcher.fingerprint_blocks(matcher.prepare_buffer(data))):
+            # only the first block of a run of identical blocks is indexed, as matches
+            # starting there are extended across the rest of the run anyway
+            if h != prev_hash:
+                if h not in self.blocks:
+                    new_hashes.append(h)
+                places = self.blocks.setdefault(h, [])
+                if len(places) < MAX_BLOCK_PLACES:
+                    places.append((file, k * BLOCK_SIZE))
+            prev_hash = h
+        self.keys = matcher.merge_keys(self.keys, new_hashes)
+        for offset, length, digest in chunker.chunks(data):
+            self.chunks.setdefault(digest, (file, offset, length))
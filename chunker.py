@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""
+Content-defined chunking using FastCDC (Xia et al., USENIX ATC 2016).
+
+A gear hash is rolled across the data, and a chunk boundary is placed wherever the
+hash has a particular bit pattern. Since the boundaries depend only on the bytes just
+before them, inserting or removing data only moves the boundaries close to the edit,
+and the rest of the chunks are unchanged.
+"""
+
+import hashlib
+import random
+
+try:
+    import numba
+    import numpy as np
+except ImportError:
+    # without numba, cut_point runs as ordinary Python, which is much slower
+    numba = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# chunks are identified by a 32-byte digest of their contents. BLAKE3 is used if it is
+# available, as it is several times faster than SHA-256
+digest_function = hashlib.sha256 if blake3 is None else blake3.blake3
+
+# chunks are never shorter than MIN_SIZE (except at the end of the data) and never
+# longer than MAX_SIZE. The average chunk length is close to AVG_SIZE
+MIN_SIZE = 2**11
+AVG_SIZE = 2**13
+MAX_SIZE = 2**16
+
+# a table of random 64-bit integers, one for each byte value. The seed is fixed so
+# that the same data is always split in the same place
+_rng = random.Random(0)
+GEAR = [_rng.getrandbits(64) for _ in range(256)]
+
+MASK_64 = (1 << 64) - 1
+# normalised chunking: before AVG_SIZE a boundary requires more bits to be zero, which
+# makes short chunks less likely, and after AVG_SIZE fewer bits are required, which
+# makes long chunks less likely. The high bits of the hash are used because they
+# depend on more of the preceding bytes than the low bits
+MASK_S = ((1 << 15) - 1) << (64 - 15)
+MASK_L = ((1 << 11) - 1) << (64 - 11)
+# the initial value of the hash
+HASH_ZERO = 0
+
+if numba is not None:
+    # numba needs the hash and everything it is combined with to be unsigned 64-bit
+    # integers; mixing them with signed integers would turn the hash into a float
+    GEAR = np.array(GEAR, dtype=np.uint64)
+    MASK_64 = np.uint64(MASK_64)
+    MASK_S = np.uint64(MASK_S)
+    MASK_L = np.uint64(MASK_L)
+    HASH_ZERO = np.uint64(0)
+
+def cut_point(data, start, stop):
+    "return the length of the chunk of data[start:stop] that starts at `start`"
+    length = stop - start
+    if length <= MIN_SIZE:
+        return length
+    length = min(length, MAX_SIZE)
+    normal = min(length, AVG_SIZE)
+
+    h = HASH_ZERO
+    i = MIN_SIZE
+    while i < normal:
+        h = ((h << 1) + GEAR[data[start + i]]) & MASK_64
+        i += 1
+        if not h & MASK_S:
+            return i
+    while i < length:
+        h = ((h << 1) + GEAR[data[start + i]]) & MASK_64
+        i += 1
+        if not h & MASK_L:
+            return i
+    return length
+
+if numba is not None:
+    cut_point = numba.njit(cache=True)(cut_point)
+
+def chunks(data):
+    "split `data` into chunks and yield (start, length, digest) for each one"
+    scan = data if numba is None else np.frombuffer(data, dtype=np.uint8)
+    # find all the boundaries first, then hash each chunk in one call
+    starts = []
+    start = 0
+    while start < len(data):
+        starts += [start]
+        start += cut_point(scan, start, len(data))
+    starts += [len(data)]
+    del scan
+
+    # chunks are hashed through a memoryview so they are not copied first
+    with memoryview(data) as view:
+        for start, stop in zip(starts, starts[1:]):
+            yield start, stop - start, digest_function(view[start:stop]).digest()
@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 
+import array
 import collections
-import difflib
+import concurrent.futures
 import logging
 import pathlib
 import sys
 import time
 
+try:
+    import inotify_simple
+except ImportError:
+    # inotify is only available on Linux. Without it, the client polls the source
+    # directory instead
+    inotify_simple = None
+
+import block_index
+import chunker
 import file_segment
+import matcher
 import server_wrapper
+from matcher import BLOCK_SIZE
 
 INTERVAL = 0.1
+# the maximum amount of literal data sent to the server in one request
+BATCH_SIZE = 2**22
+# the maximum number of batches being uploaded at the same time
+UPLOAD_WORKERS = 8
 
 log = logging.getLogger("client")
 log.addHandler(logging.StreamHandler(sys.stderr))
@@ -19,7 +35,7 @@ log.setLevel(logging.DEBUG)
 Chunk = collections.namedtuple("Chunk", ("length", "start", "other_file_start", "other_file"))
 
 class Client:
-    "watches a directory and periodically uploads any new files it contains"
+    "watches a directory and uploads any new files it contains"
     def __init__(self, server, source, server_interface):
         # server should be a string with the server's URL
         # server_interface can be either requests (the package) or a Flask test_client,
@@ -27,15 +43,38 @@ class Client:
         self.server = server_wrapper.Server(server, server_interface)
         self.source = source
         self.uploaded_files = set()
+        self.index = block_index.BlockIndex()
 
     def check(self):
         "check the source directory for new files and upload them"
         new_files = set(self.source.iterdir())
 
         for file in new_files - self.uploaded_files:
-            log.info(f"Uploading {file}")
-            upload_file(file, self.uploaded_files, self.server)
+            self.upload(file)
+
+    def upload(self, file):
+        """
+        upload `file` if it has not been uploaded already. If the upload fails, the error
+        is logged rather than raised, so that one file cannot stop the client from
+        uploading the others; the file is tried again the next time the source directory
+        is checked
+        """
+        if file in self.uploaded_files:
+            return
+        log.info(f"Uploading {file}")
+        try:
+            # the file is only stat'ed once, and its size is passed to everything that
+            # needs it
+            file_size = file.stat().st_size
+            upload_file(file, self.index, self.server, file_size)
             self.uploaded_files.add(file)
+            self.index.add(file, file_size)
+        except FileNotFoundError:
+            # e.g. a temporary file that an editor or rsync renamed as soon as it was
+            # written; the file it was renamed to is uploaded instead
+            log.info(f"{file} was removed before it could be uploaded")
+        except (OSError, server_wrapper.requests.RequestException) as e:
+            log.error(f"Failed to upload {file}: {e}")
 
     def loop(self, interval):
         "check the source directory forever"
@@ -43,72 +82,290 @@ class Client:
             time.sleep(interval)
             self.check()
 
-def get_chunks(file, min_size, uploaded_files):
-    "return a list of Chunks, at least `min_size` in length, that are shared by `file` and any of the files in `uploaded_files`"
-    for other_file in uploaded_files:
-        s = difflib.SequenceMatcher(None, file.read_bytes(), other_file.read_bytes())
-        for chunk in s.get_matching_blocks():
-            if chunk.size >= min_size:
-                yield Chunk(chunk.size, chunk.a, chunk.b, other_file)
+    def watch(self):
+        "upload new files as soon as they are written to the source directory, until the directory is removed"
+        flags = inotify_simple.flags
+        with inotify_simple.INotify() as inotify:
+            # files are uploaded once they have been closed after writing, or moved into
+            # the source directory
+            inotify.add_watch(self.source, flags.CLOSE_WRITE | flags.MOVED_TO)
+            # pick up any files that were already there before the watch started
+            self.check()
+            while True:
+                for event in inotify.read():
+                    if event.mask & flags.Q_OVERFLOW:
+                        # the kernel's event queue overflowed and some events were lost,
+                        # so look for any files that were missed
+                        self.check()
+                    elif event.mask & flags.IGNORED:
+                        # the watch was removed because the source directory was deleted
+                        return
+                    elif event.name and not event.mask & flags.ISDIR:
+                        self.upload(self.source/event.name)
+
+def match_length(a, a_start, b, b_start, limit):
+    "return the length (at most `limit`) of the common prefix of a[a_start:] and b[b_start:]"
+    length = 0
+    # compare whole blocks first, then single bytes
+    while length + BLOCK_SIZE <= limit and \
+            a[a_start + length:a_start + length + BLOCK_SIZE] == b[b_start + length:b_start + length + BLOCK_SIZE]:
+        length += BLOCK_SIZE
+    while length < limit and a[a_start + length] == b[b_start + length]:
+        length += 1
+    return length
+
+def match_length_backwards(a, a_stop, b, b_stop, limit):
+    "return the length (at most `limit`) of the common suffix of a[:a_stop] and b[:b_stop]"
+    length = 0
+    while length < limit and a[a_stop - length - 1] == b[b_stop - length - 1]:
+        length += 1
+    return length
+
+def match_chunks(buf, stop, chunk_index):
+    "return a list of Chunks made of whole content-defined chunks of buf[:stop] that are in `chunk_index`"
+    chunks = []
+    with buf[:stop] as view:
+        for start, length, digest in chunker.chunks(view):
+            if digest not in chunk_index:
+                continue
+            other_file, other_start, _ = chunk_index[digest]
+            # merge with the previous chunk if both are consecutive in both files
+            if chunks and chunks[-1].start + chunks[-1].length == start \
+                    and chunks[-1].other_file == other_file \
+                    and chunks[-1].other_file_start + chunks[-1].length == other_start:
+                chunks[-1] = chunks[-1]._replace(length=chunks[-1].length + length)
+            else:
+                chunks += [Chunk(length, start, other_start, other_file)]
+    return chunks
+
+def match_blocks(buf, start, stop, index, scan_buf):
+    """
+    yield Chunks of buf[start:stop] that are shared with any of the blocks in `index`;
+    `scan_buf` is `buf` as returned by matcher.prepare_buffer
+    """
+    # the end of the last chunk we found; chunks are never extended back past this
+    last_end = start
+    i = start
+    # the fingerprint of the previous window, if it did not match anything, otherwise -1
+    prev_miss = -1
+    while True:
+        # find the next window whose fingerprint is in the index. In a run of
+        # identical bytes the fingerprint stays the same as the window moves, and if
+        # the previous window did not match then this one will not either, so
+        # windows with the same fingerprint as a previous miss are skipped
+        i, h = matcher.find_block(scan_buf, i, stop, prev_miss, index.keys)
+        if i == -1:
+            break
+
+        # find the longest match for the block starting at i
+        best = None
+        for other_file, other_start in index.blocks[h]:
+            other = index.contents[other_file]
+            if buf[i:i + BLOCK_SIZE] != other[other_start:other_start + BLOCK_SIZE]:
+                # fingerprint collision
+                continue
+            # extend the match in both directions to make it as long as possible
+            back = match_length_backwards(buf, i, other, other_start, min(i - last_end, other_start))
+            forward = match_length(buf, i, other, other_start, min(stop - i, len(other) - other_start))
+            if best is None or back + forward > best.length:
+                best = Chunk(back + forward, i - back, other_start - back, other_file)
+            if i + forward == stop:
+                # no other place can be matched any further forward
+                break
+
+        if best is not None:
+            # these are simple matches: each one is copied from a single place in a
+            # single uploaded file
+            yield best
+            prev_miss = -1
+            # skip past the match and start a new window after it
+            i = last_end = best.start + best.length
+        else:
+            prev_miss = h
+            i += 1
 
-def get_file_parts(file, uploaded_files):
+def get_chunks(file, min_size, index, file_size=None):
+    "return a list of Chunks, at least `min_size` in length, that are shared by `file` and any of the files in the BlockIndex `index`"
+    if file_size is None:
+        file_size = file.stat().st_size
+    if file_size == 0:
+        return
+
+    with file.open("rb") as f:
+        # the file is read into memory rather than memory-mapped, as reading a map of a
+        # file that is truncated while it is being searched kills the client with
+        # SIGBUS. If the file has grown since it was stat'ed, only its first `file_size`
+        # bytes are uploaded, so only they are read and searched
+        buf = memoryview(f.read(file_size))
+    scan_buf = matcher.prepare_buffer(buf)
+
+    # whole content-defined chunks are looked up first, as this only takes one lookup
+    # per chunk ...
+    idx = 0
+    for chunk in match_chunks(buf, len(buf), index.chunks):
+        # ... then the gaps between them are searched block by block
+        for c in match_blocks(buf, idx, chunk.start, index, scan_buf):
+            if c.length >= min_size:
+                yield c
+        if chunk.length >= min_size:
+            yield chunk
+        idx = chunk.start + chunk.length
+    for c in match_blocks(buf, idx, len(buf), index, scan_buf):
+        if c.length >= min_size:
+            yield c
+
+def get_file_parts(file, index, file_size=None):
     "return a list of Chunks that, when reassembled, produces a copy of `file`"
-    file_size = file.stat().st_size
+    if file_size is None:
+        file_size = file.stat().st_size
 
-    # get a list of chunks shared with other files and sort them by size
-    chunks = get_chunks(file, 32, uploaded_files)
-    chunks = sorted(chunks, key=lambda c: c.length, reverse=True)
+    # get a list of chunks shared with other files. There can be many of these, so
+    # they are stored field by field in arrays rather than as Chunks, and are referred
+    # to by their indices in these arrays
+    lengths = array.array("Q")
+    starts = array.array("Q")
+    other_file_starts = array.array("Q")
+    other_files = []
+    for chunk in get_chunks(file, BLOCK_SIZE, index, file_size):
+        lengths.append(chunk.length)
+        starts.append(chunk.start)
+        other_file_starts.append(chunk.other_file_start)
+        other_files.append(chunk.other_file)
+    # sort the chunks by size
+    chunks = sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True)
 
     used_chunks = []
     # initialise a FileSegment object to track which parts of the file are still missing
-    file_segments = file_segment.FileSegment(file_size)
-    for chunk in chunks:
+    file_segments = file_segment.for_length(file_size)
+    for i in chunks:
         # R is the chunk in (start, stop) form
         # if R represents a part of the file that is not already accounted for, then
         # add the chunk to our list of chunks and remove it from the file
-        if (R := (chunk.start, chunk.start + chunk.length - 1)) in file_segments:
+        if (R := (starts[i], starts[i] + lengths[i] - 1)) in file_segments:
             file_segments.remove(*R)
-            used_chunks += [chunk]
-    # sort the chunks by their start position, i.e. their position in `file`
-    used_chunks = sorted(used_chunks, key=lambda c: c.start)
+            used_chunks += [i]
+    # sort the chunks by their start position, i.e. their position in `file`, and turn
+    # them back into Chunks
+    used_chunks = sorted(used_chunks, key=starts.__getitem__)
+    used_chunks = [Chunk(lengths[i], starts[i], other_file_starts[i], other_files[i]) for i in used_chunks]
 
     # at this point, there are some sections of `file` that are not accounted for by
     # chunks in `used_chunks`
 
-    # used idx to track our position in file
+    # used idx to track our position in file, and i to track the next chunk in
+    # used_chunks
     idx = 0
-    while idx < file_size - 1:
+    i = 0
+    while idx < file_size:
         # if there is a chunk from another file starting at the current index, use that
-        if used_chunks and used_chunks[0].start == idx:
-            chunk = used_chunks.pop(0)
+        if i < len(used_chunks) and used_chunks[i].start == idx:
+            chunk = used_chunks[i]
+            i += 1
             yield chunk
             idx += chunk.length
         else:
             # otherwise, read from `file` until ...
-            if used_chunks:
+            if i < len(used_chunks):
                 # ... the start of the next chunk, if there is one available
-                yield Chunk(used_chunks[0].start - idx, idx, None, None)
-                idx = used_chunks[0].start
+                yield Chunk(used_chunks[i].start - idx, idx, None, None)
+                idx = used_chunks[i].start
             else:
                 # ... the end of the file, if no chunks are available
                 yield Chunk(file_size - idx, idx, None, None)
                 idx += file_size - idx
 
-def upload_file(file: pathlib.Path, uploaded_files, wrapper):
-    "upload a file to the server"
+def read_literals(f, ops, batch_size):
+    """
+    read the data for the literal operations in `ops`, `batch_size` bytes in total, from
+    the unbuffered file object `f`, and return `ops` with each one's "length" field
+    replaced by its data
+    """
+    # the data for the whole batch is read into one buffer, and each operation is given
+    # a slice of it, so there is one allocation per batch rather than one per operation
+    buf = memoryview(bytearray(batch_size))
+    pos = 0
+    for op in ops:
+        if op["type"] == "literal":
+            data = buf[pos:pos + op.pop("length")]
+            op["data"] = data
+            pos += len(data)
+            f.seek(op["start"])
+            while data:
+                read = f.readinto(data)
+                if not read:
+                    raise OSError(f"{f.name} was truncated while it was being uploaded")
+                data = data[read:]
+    return ops
+
+def get_batches(file: pathlib.Path, index, file_size=None):
+    "return a list of batches of operations that, when applied in any order, produce a copy of `file`"
 
-    with file.open("rb") as orig_file:
-        for chunk in get_file_parts(file, uploaded_files):
+    # the parts of the file are sent to the server in batches of operations; each
+    # operation either writes some literal data into the file or copies data into it
+    # from another file, at the position given by its "start" field
+    ops = []
+    # the amount of literal data in `ops`
+    batch_size = 0
+    if file_size is None:
+        file_size = file.stat().st_size
+    if file_size == 0:
+        # empty files have no parts
+        return
+    # literal data is read from `file` once a batch is complete, rather than being
+    # sliced out of a memory map of it, as reading a map of a file that is truncated
+    # while it is being uploaded kills the client with SIGBUS
+    with file.open("rb", buffering=0) as f:
+        for chunk in get_file_parts(file, index, file_size):
             if chunk.other_file is None:
-                # if chunk.other_file is none, we read data out of `file`
-                orig_file.seek(chunk.start)
-                chunk = orig_file.read(chunk.length)
-                wrapper.upload(chunk, file)
+                # if chunk.other_file is none, we read data out of `file`. Long chunks
+                # are split so that no batch contains more than BATCH_SIZE bytes
+                start = chunk.start
+                stop = chunk.start + chunk.length
+                while start < stop:
+                    length = min(stop - start, BATCH_SIZE - batch_size)
+                    ops += [{"type": "literal", "start": start, "length": length}]
+                    batch_size += length
+                    start += length
+                    if batch_size == BATCH_SIZE:
+                        yield read_literals(f, ops, batch_size)
+                        ops = []
+                        batch_size = 0
             else:
                 # if chunk.other_file is a file, there is no need to read anything, as
                 # the server already has the data (unless the file that the server has
                 # access to has been deleted, but we pretend this won't happen)
-                wrapper.copy(file, chunk.other_file, chunk.other_file_start, chunk.length)
+                ops += [{
+                    "type": "copy",
+                    "start": chunk.start,
+                    "other_file": chunk.other_file,
+                    "offset": chunk.other_file_start,
+                    "length": chunk.length
+                    }]
+        if ops:
+            yield read_literals(f, ops, batch_size)
+
+def upload_file(file: pathlib.Path, index, wrapper, file_size=None):
+    "upload a file to the server"
+
+    # the size of the file is sent with every batch, so the server can allocate space
+    # for the whole file whichever batch arrives first
+    if file_size is None:
+        file_size = file.stat().st_size
+    # every operation writes to its own part of the file, so batches can be uploaded
+    # concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        pending = set()
+        for ops in get_batches(file, index, file_size):
+            # wait for an upload to finish before reading the next batch, so that only
+            # a few batches are held in memory at once
+            if len(pending) >= UPLOAD_WORKERS:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(pool.submit(wrapper.batch, file, ops, file_size))
+        # re-raise any exceptions from the uploads
+        for future in pending:
+            future.result()
 
 if __name__ == "__main__":
     source = pathlib.Path(sys.argv[1])
@@ -116,4 +373,7 @@ if __name__ == "__main__":
     log.info(f"Started Fropbox client, watching {source}")
 
     c = Client("http://127.0.0.1:11000", source, server_wrapper.requests)
-    c.loop(INTERVAL)
+    if inotify_simple is None:
+        c.loop(INTERVAL)
+    else:
+        c.watch()
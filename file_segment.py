@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import sortedcontainers
+
 class FileSegment:
     """
     A FileSegment object represents a file as a list of bytes. This is done using an
@@ -15,28 +17,86 @@ class FileSegment:
     Segments can be removed from the list:
 
         [(0, 9)].remove(4, 5) -> [(0, 3), (6, 9)]
+
+    The segments never overlap, and are kept sorted by their start positions so that
+    both operations only need to look at the segments around R.
     """
 
     def __init__(self, length):
-        self.segments = [(0, length - 1)]
+        self.segments = sortedcontainers.SortedKeyList([(0, length - 1)], key=lambda s: s[0])
 
     def remove(self, start, stop):
         "remove some segment R (start, stop) from the list of segments"
         # https://helloacm.com/algorithm-to-remove-a-interval-from-segments/
 
-        new_segments = []
-        for seg_start, seg_stop in self.segments:
+        # the segments that overlap R are the last segment starting before R, if it
+        # extends into R, and every segment starting inside R
+        overlapping = list(self.segments.irange_key(start, stop))
+        idx = self.segments.bisect_key_left(start) - 1
+        if idx >= 0 and self.segments[idx][1] >= start:
+            overlapping += [self.segments[idx]]
+
+        for seg_start, seg_stop in overlapping:
+            self.segments.remove((seg_start, seg_stop))
             if seg_start < start:
-                new_segments += [(seg_start, min(start - 1, seg_stop))]
+                self.segments.add((seg_start, min(start - 1, seg_stop)))
             if seg_stop > stop:
-                new_segments += [(max(stop + 1, seg_start), seg_stop)]
+                self.segments.add((max(stop + 1, seg_start), seg_stop))
 
-        self.segments = new_segments
+    def __contains__(self, R):
+        "return True if segment R (start, stop) is fully contained within one of the existing segments"
+        start, stop = R
+        # find the last segment that starts at or before R
+        idx = self.segments.bisect_key_right(start) - 1
+        if idx < 0:
+            return False
+        return stop <= self.segments[idx][1]
+
+class BitmapFileSegment:
+    """
+    A BitmapFileSegment object behaves like a FileSegment object, but represents the
+    file as a bitmap with one byte for every byte of the file, which is 1 if that byte
+    is still in the list of segments and 0 if it has been removed. Both operations are
+    then a single slice operation, which is faster than FileSegment for small files but
+    needs memory proportional to the length of the file.
+    """
+
+    def __init__(self, length):
+        self.free = bytearray(b"\x01") * length
+
+    def remove(self, start, stop):
+        "remove some segment R (start, stop) from the list of segments"
+        start = max(start, 0)
+        stop = min(stop, len(self.free) - 1)
+        if start <= stop:
+            self.free[start:stop + 1] = bytes(stop + 1 - start)
 
     def __contains__(self, R):
         "return True if segment R (start, stop) is fully contained within one of the existing segments"
         start, stop = R
-        for seg_start, seg_stop in self.segments:
-            if start >= seg_start and stop <= seg_stop:
-                return True
-        return False
+        if start < 0 or stop >= len(self.free):
+            return False
+        # R is contained if none of its bytes have been removed
+        return self.free.find(0, start, stop + 1) == -1
+
+    @property
+    def segments(self):
+        "the list of segments, in the same form as FileSegment.segments"
+        segments = []
+        start = self.free.find(1)
+        while start != -1:
+            stop = self.free.find(0, start)
+            if stop == -1:
+                stop = len(self.free)
+            segments += [(start, stop - 1)]
+            start = self.free.find(1, stop)
+        return segments
+
+# files up to this length are tracked with a BitmapFileSegment
+BITMAP_MAX_LENGTH = 2**24
+
+def for_length(length):
+    "return a FileSegment or BitmapFileSegment object, whichever is best for a file of length `length`"
+    if length <= BITMAP_MAX_LENGTH:
+        return BitmapFileSegment(length)
+    return FileSegment(length)
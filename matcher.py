@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+try:
+    import numba
+    import numpy as np
+except ImportError:
+    # without numba, the functions below run as ordinary Python, which is much slower
+    numba = None
+
+# files are indexed in aligned blocks of BLOCK_SIZE bytes, so this is also the shortest
+# repeated sequence that can be found
+BLOCK_SIZE = 32
+# base and modulus of the polynomial rolling hash used to fingerprint blocks. The
+# modulus is the largest prime below 2**53, which is small enough that updating the hash
+# never overflows a 64-bit integer
+HASH_BASE = 257
+HASH_MOD = 2**53 - 111
+# weight of the byte that leaves the window when the rolling hash advances by one byte
+HASH_BASE_N = pow(HASH_BASE, BLOCK_SIZE, HASH_MOD)
+
+# the index of blocks and the buffers being scanned are stored in whichever form is
+# fastest for the functions below to read: numba needs the fingerprints in a sorted
+# array and buffers in numpy arrays, while plain Python can use them as they are
+if numba is None:
+    def prepare_keys(blocks):
+        "return the fingerprints in `blocks` in a form that can be passed to find_block"
+        return blocks
+
+    def merge_keys(keys, fingerprints):
+        "return `keys`, as returned by prepare_keys, with the new `fingerprints` added to it"
+        # the dict of blocks is searched directly, so it already contains them
+        return keys
+
+    def prepare_buffer(buf):
+        "return `buf` in a form that can be passed to the functions below"
+        return buf
+
+    def contains(keys, h):
+        "return True if `h` is in `keys`"
+        return h in keys
+else:
+    def prepare_keys(blocks):
+        "return the fingerprints in `blocks` in a form that can be passed to find_block"
+        keys = np.fromiter(blocks.keys(), dtype=np.int64, count=len(blocks))
+        keys.sort()
+        return keys
+
+    def merge_keys(keys, fingerprints):
+        "return `keys`, as returned by prepare_keys, with the new `fingerprints` added to it"
+        # the new fingerprints are inserted at their positions in the sorted array, which
+        # copies the existing keys once rather than sorting them all again
+        fingerprints = np.sort(np.array(fingerprints, dtype=np.int64))
+        return np.insert(keys, np.searchsorted(keys, fingerprints), fingerprints)
+
+    def prepare_buffer(buf):
+        "return `buf` in a form that can be passed to the functions below"
+        return np.frombuffer(buf, dtype=np.uint8)
+
+    @numba.njit(cache=True)
+    def contains(keys, h):
+        "return True if `h` is in `keys`"
+        k = np.searchsorted(keys, h)
+        return k < len(keys) and keys[k] == h
+
+def fingerprint(buf, start):
+    "return the rolling hash of the block buf[start:start + BLOCK_SIZE]"
+    h = 0
+    for j in range(start, start + BLOCK_SIZE):
+        h = (h * HASH_BASE + buf[j]) % HASH_MOD
+    return h
+
+def fingerprint_blocks(buf):
+    "return a list of the fingerprints of each aligned block in `buf`"
+    fingerprints = [0] * (len(buf) // BLOCK_SIZE)
+    for k in range(len(fingerprints)):
+        fingerprints[k] = fingerprint(buf, k * BLOCK_SIZE)
+    return fingerprints
+
+def find_block(buf, start, stop, prev_hash, keys):
+    """
+    Slide a window of BLOCK_SIZE bytes across buf[start:stop], and return the position
+    of the first window whose fingerprint is in `keys`, along with that fingerprint. If
+    no window matches, the position is -1.
+
+    Windows are skipped if their fingerprint is the same as the fingerprint of the
+    window before them, since the window before did not match either; `prev_hash` is
+    the fingerprint of the window before `start`, or -1 if it should not be skipped.
+    """
+    if stop - start < BLOCK_SIZE:
+        return -1, 0
+
+    h = fingerprint(buf, start)
+    i = start
+    while True:
+        if h != prev_hash and contains(keys, h):
+            return i, h
+        if i + BLOCK_SIZE >= stop:
+            return -1, h
+        prev_hash = h
+        # HASH_MOD * 256 is added to keep the intermediate value positive
+        h = (h * HASH_BASE + HASH_MOD * 256 - buf[i] * HASH_BASE_N + buf[i + BLOCK_SIZE]) % HASH_MOD
+        i += 1
+
+if numba is not None:
+    fingerprint = numba.njit(cache=True)(fingerprint)
+    find_block = numba.njit(cache=True)(find_block)
+
+    @numba.njit(cache=True)
+    def _fingerprint_blocks(buf):
+        fingerprints = np.empty(len(buf) // BLOCK_SIZE, dtype=np.int64)
+        for k in range(len(fingerprints)):
+            fingerprints[k] = fingerprint(buf, k * BLOCK_SIZE)
+        return fingerprints
+
+    def fingerprint_blocks(buf):
+        "return a list of the fingerprints of each aligned block in `buf`"
+        return _fingerprint_blocks(buf).tolist()
@@ -1,32 +1,117 @@
 #!/usr/bin/env python3
 
+import json
 import logging
 import os
 import pathlib
 import sys
+import threading
 
 import flask
 
+try:
+    import zstandard
+except ImportError:
+    # without zstandard, the server only accepts uncompressed data
+    zstandard = None
+
 log = logging.getLogger("client")
 log.addHandler(logging.StreamHandler(sys.stderr))
 log.setLevel(logging.DEBUG)
 
+# content type of the body of a request to /batch. This is the same as
+# server_wrapper.BATCH_CONTENT_TYPE, but is not imported from there, so that the server
+# does not depend on requests
+BATCH_CONTENT_TYPE = "application/x-fropbox-batch"
+
+# the amount of data read at a time when copying between files without sendfile
+COPY_BUFFER_SIZE = 2**20
+
+# decompressors are reused, but a decompressor cannot be used by several threads at
+# once, so each thread has its own
+_local = threading.local()
+
+def request_data():
+    "return the body of the current request, decompressing it if necessary"
+    data = flask.request.get_data()
+    encoding = flask.request.content_encoding
+    if not encoding:
+        return data
+    if encoding != "zstd" or zstandard is None:
+        # the encodings that are accepted are listed in the response, as in RFC 7694,
+        # which lets clients tell this apart from other requests rejected with status 415
+        accepted = "identity" if zstandard is None else "zstd, identity"
+        flask.abort(flask.make_response("", 415, {"Accept-Encoding": accepted}))
+    if not hasattr(_local, "decompressor"):
+        _local.decompressor = zstandard.ZstdDecompressor()
+    return _local.decompressor.decompress(data)
+
+def copy_range(src_fd, offset, dst_fd, start, length):
+    "copy `length` bytes from `src_fd` at `offset` into `dst_fd` at `start`"
+    try:
+        # on Linux, sendfile copies the data inside the kernel without it passing
+        # through Python. It writes to the current position of dst_fd
+        os.lseek(dst_fd, start, os.SEEK_SET)
+        while length > 0:
+            sent = os.sendfile(dst_fd, src_fd, offset, length)
+            if sent == 0:
+                # the end of src_fd
+                return
+            offset += sent
+            start += sent
+            length -= sent
+    except (AttributeError, OSError):
+        # sendfile is not available, or (e.g. on macOS) it can only write to sockets
+        while length > 0:
+            data = os.pread(src_fd, min(length, COPY_BUFFER_SIZE), offset)
+            if not data:
+                return
+            os.pwrite(dst_fd, data, start)
+            offset += len(data)
+            start += len(data)
+            length -= len(data)
+
 def make_app(dest):
     "create a Flask app that will download files and write them to `dest`"
 
     app = flask.Flask("Fropbox server")
 
+    def open_file(file, file_size=None):
+        """
+        open `file` for writing at arbitrary positions, creating it if it does not
+        exist, and return its file descriptor. If `file_size` is given, space for the
+        whole file is allocated up front
+        """
+        fd = os.open(file, os.O_WRONLY | os.O_CREAT, 0o644)
+        if file_size is not None and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, file_size)
+            except OSError:
+                # allocation is only an optimisation, and some filesystems do not
+                # support it
+                pass
+        return fd
+
     @app.route("/upload/<file_name>", methods=["POST"])
     def upload(file_name):
         file = dest/file_name
-        data = flask.request.data
+        data = request_data()
+        offset = flask.request.args.get("offset", type=int)
 
-        # create `file` if it does not exist
-        if not file.exists():
-            file.touch()
-        # append the data we received to the end of `file`
-        with file.open("ab") as f:
-            f.write(data)
+        if offset is None:
+            # create `file` if it does not exist
+            if not file.exists():
+                file.touch()
+            # append the data we received to the end of `file`
+            with file.open("ab") as f:
+                f.write(data)
+        else:
+            # write the data we received into `file` at `offset`
+            fd = open_file(file)
+            try:
+                os.pwrite(fd, data, offset)
+            finally:
+                os.close(fd)
 
         return flask.make_response({}, 200)
 
@@ -39,15 +124,54 @@ def make_app(dest):
 
         src_file = dest/other_file
         dst_file = dest/file_name
-        # create the destination file if it does not exist
+        # the destination file is created if it does not exist
         # the source file may not exist but we assume this will never happen
-        if not dst_file.exists():
-            dst_file.touch()
-        with src_file.open("rb") as src, dst_file.open("ab") as dst:
-            # read from src and write the data into dst
-            src.seek(offset)
-            chunk = src.read(length)
-            dst.write(chunk)
+        src_fd = os.open(src_file, os.O_RDONLY)
+        dst_fd = open_file(dst_file)
+        try:
+            # copy from src to the end of dst
+            copy_range(src_fd, offset, dst_fd, os.fstat(dst_fd).st_size, length)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+        return flask.make_response({}, 200)
+
+    @app.route("/batch", methods=["POST"])
+    def batch():
+        # the mimetype leaves out any parameters, e.g. a charset, given with the type
+        if flask.request.mimetype != BATCH_CONTENT_TYPE:
+            flask.abort(415)
+        # the body is a JSON header, preceded by its length, followed by the data for
+        # the literal operations; see server_wrapper.Server.batch
+        body = memoryview(request_data())
+        header_length = int.from_bytes(body[:4], "little")
+        header = json.loads(bytes(body[4:4 + header_length]))
+        file_name = header["file_name"]
+        file_size = header.get("file_size")
+        ops = header["ops"]
+        # the position in `body` of the data for the next literal operation
+        pos = 4 + header_length
+
+        # apply each operation in turn, writing to the position given by its "start"
+        # field, all through the same file descriptor. Since every write has an
+        # explicit position, several batches for the same file can be applied at once
+        fd = open_file(dest/file_name, file_size)
+        try:
+            for op in ops:
+                if op["type"] == "literal":
+                    os.pwrite(fd, body[pos:pos + op["length"]], op["start"])
+                    pos += op["length"]
+                elif op["type"] == "copy":
+                    src_fd = os.open(dest/op["other_file"], os.O_RDONLY)
+                    try:
+                        copy_range(src_fd, op["offset"], fd, op["start"], op["length"])
+                    finally:
+                        os.close(src_fd)
+                else:
+                    flask.abort(400)
+        finally:
+            os.close(fd)
 
         return flask.make_response({}, 200)
 
@@ -1,16 +1,111 @@
 #!/usr/bin/env python3
 
+import json
+import threading
+
 import requests
+import requests.adapters
+import urllib3.util
+
+try:
+    import zstandard
+except ImportError:
+    # without zstandard, data is sent to the server uncompressed
+    zstandard = None
+
+# the number of connections kept open to the server; this should be at least the number
+# of batches the client uploads at the same time
+POOL_SIZE = 16
+
+# content type of the body of a request to /batch
+BATCH_CONTENT_TYPE = "application/x-fropbox-batch"
+
+# zstd compression level for data sent to the server; level 3 is zstd's default, and
+# is fast enough that compressing is quicker than sending the data uncompressed
+COMPRESSION_LEVEL = 3
+
+# compressors are reused, but a compressor cannot be used by several threads at once,
+# so each thread has its own
+_local = threading.local()
+
+def compress(data):
+    """
+    return `data` compressed with zstd and the value of the Content-Encoding header to
+    send it with, or `data` unchanged and None if compressing it does not make it smaller
+    """
+    if zstandard is None:
+        return data, None
+    if not hasattr(_local, "compressor"):
+        _local.compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+    compressed = _local.compressor.compress(data)
+    if len(compressed) >= len(data):
+        # e.g. the data is random or already compressed
+        return data, None
+    return compressed, "zstd"
+
+def check_response(response):
+    "raise requests.HTTPError if the server responded to a request with an error status"
+    # responses from a Flask test_client do not have raise_for_status
+    if response.status_code >= 400:
+        raise requests.HTTPError(f"{response.status_code} error from the server", response=response)
+
+def rejects_encoding(response, encoding):
+    """
+    return True if the server responded to a request by rejecting its Content-Encoding,
+    `encoding`. The server lists the encodings it accepts in the response, as in RFC
+    7694, so this is not confused with other requests rejected with status 415
+    """
+    if response.status_code != 415 or "Accept-Encoding" not in response.headers:
+        return False
+    accepted = {e.split(";")[0].strip() for e in response.headers["Accept-Encoding"].split(",")}
+    return encoding not in accepted
 
 class Server:
 
     def __init__(self, hostname, server_interface):
         "server_interface must be `requests` or a Flask test_client"
         self.hostname = hostname
+        if server_interface is requests:
+            # use a session, so that connections to the server are kept alive and
+            # reused instead of being opened for every request. Failed connections
+            # are retried; requests that reached the server are not, as appending
+            # to a file twice is not safe
+            server_interface = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=POOL_SIZE,
+                    pool_maxsize=POOL_SIZE,
+                    max_retries=urllib3.util.Retry(total=3, backoff_factor=0.1)
+                    )
+            server_interface.mount("http://", adapter)
+            server_interface.mount("https://", adapter)
         self.server_interface = server_interface
+        # set to False once the server has rejected the encoding of a compressed
+        # request, e.g. because it does not have zstandard installed
+        self.compression = True
+
+    def post_data(self, url, data, headers):
+        """
+        post `data` to `url`, compressed if it is worth compressing and the server
+        accepts compressed data, and raise requests.HTTPError if the request fails
+        """
+        if self.compression:
+            compressed, encoding = compress(data)
+            if encoding is not None:
+                response = self.server_interface.post(url, data=compressed, headers=dict(headers, **{"Content-Encoding": encoding}))
+                if not rejects_encoding(response, encoding):
+                    check_response(response)
+                    return
+                # the server rejects a compressed body before acting on it, so it is
+                # safe to send it again uncompressed
+                self.compression = False
+        check_response(self.server_interface.post(url, data=data, headers=headers))
 
-    def upload(self, data, file):
-        self.server_interface.post(f"{self.hostname}/upload/{file.name}", data=data)
+    def upload(self, data, file, offset=None):
+        "append `data` to `file`, or write it at `offset` if one is given"
+        url = f"{self.hostname}/upload/{file.name}"
+        if offset is not None:
+            url += f"?offset={offset}"
+        self.post_data(url, data, {})
 
     def copy(self, file, other_file, offset, length):
         data = {
@@ -19,4 +114,29 @@ class Server:
                 "offset": offset,
                 "length": length
                 }
-        self.server_interface.post(f"{self.hostname}/copy", json=data)
+        check_response(self.server_interface.post(f"{self.hostname}/copy", json=data))
+
+    def batch(self, file, ops, file_size=None):
+        "apply a list of literal and copy operations to `file`, as produced by client.get_batches"
+        # the body of the request consists of a JSON header describing the operations,
+        # preceded by its length as a 4-byte little-endian integer, followed by the
+        # data for each literal operation in the same order as the operations. This
+        # avoids inflating the data by encoding it to fit in the JSON
+        header_ops = []
+        literals = []
+        for op in ops:
+            if op["type"] == "literal":
+                header_ops += [{"type": "literal", "start": op["start"], "length": len(op["data"])}]
+                literals += [op["data"]]
+            else:
+                header_ops += [dict(op, other_file=op["other_file"].name)]
+        header = {
+                "file_name": file.name,
+                "file_size": file_size,
+                "ops": header_ops
+                }
+        header = json.dumps(header).encode()
+        data = b"".join([len(header).to_bytes(4, "little"), header] + literals)
+        # the whole body is compressed together, so the literal data does not have to
+        # be copied again to frame each piece separately
+        self.post_data(f"{self.hostname}/batch", data, {"Content-Type": BATCH_CONTENT_TYPE})
@@ -1,18 +1,49 @@
 #!/usr/bin/env python3
 
 import collections
+import concurrent.futures
 import inspect
 import itertools
+import json
+import mmap
 import os
 import pathlib
 import random
 import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
-from file_segment import FileSegment
+from block_index import BlockIndex, MAX_BLOCK_PLACES
+from file_segment import BitmapFileSegment, FileSegment
 
+import chunker
 import client
+import matcher
 import server
+import server_wrapper
+
+# the directory in which the tests create their temporary files, e.g. /dev/shm to keep
+# them in memory. If it is not set, the system's default temporary directory is used
+TMPROOT = os.environ.get("FROPBOX_TEST_TMP")
+
+# random data for the test fixtures is sliced out of this pool, rather than generated
+# separately for every fixture
+RANDOM_POOL = os.urandom(2**18)
+_random_pool_position = 0
+
+def random_bytes(n):
+    """
+    return `n` random bytes from RANDOM_POOL. Consecutive calls return different parts of
+    the pool, so the data only repeats once the whole pool has been used
+    """
+    global _random_pool_position
+    if _random_pool_position + n > len(RANDOM_POOL):
+        _random_pool_position = 0
+    data = RANDOM_POOL[_random_pool_position:_random_pool_position + n]
+    _random_pool_position += n
+    return data
 
 # recipe from itertools
 def grouper(iterable, n, fillvalue=None):
@@ -21,6 +52,72 @@ def grouper(iterable, n, fillvalue=None):
     args = [iter(iterable)] * n
     return itertools.zip_longest(*args, fillvalue=fillvalue)
 
+def clear_directory(directory):
+    "remove every file in `directory`"
+    for file in directory.iterdir():
+        file.unlink()
+
+def pad_sections(sections, padding_length=2**6):
+    """
+    return the pieces of a file made of `sections`, with `padding_length` bytes of
+    random padding before each section and after the last one, along with the position
+    of each section in the file
+    """
+    # take all of the padding at once, and split it up between the sections
+    padding = random_bytes(padding_length * (len(sections) + 1))
+    pieces = [padding[:padding_length]]
+    positions = []
+    position = padding_length
+    for k, section in enumerate(sections, 1):
+        positions += [position]
+        position += len(section) + padding_length
+        pieces += [section, padding[k * padding_length:(k + 1) * padding_length]]
+    return positions, pieces
+
+def write_pieces(file, pieces):
+    "write the concatenation of `pieces` to `file`, in a single system call if possible"
+    fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        written = os.writev(fd, pieces) if hasattr(os, "writev") else 0
+        # writev may not write everything it is given, and is not available on all
+        # platforms, so anything that is left over is written normally
+        if written < sum(map(len, pieces)):
+            rest = memoryview(b"".join(pieces))[written:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+    finally:
+        os.close(fd)
+
+def make_index(*files):
+    "return a BlockIndex containing every file in `files`"
+    index = BlockIndex()
+    for file in files:
+        index.add(file)
+    return index
+
+class FileMaps:
+    """
+    A FileMaps object memory-maps files when they are first looked up in it, so that each
+    file only has to be opened once however many times it is read. The maps are closed
+    when the object is used as a context manager and the context exits
+    """
+
+    def __init__(self):
+        self.maps = {}
+
+    def __getitem__(self, file):
+        if file not in self.maps:
+            with file.open("rb") as f:
+                self.maps[file] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[file]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for m in self.maps.values():
+            m.close()
+
 class CallLogger:
     """
     A CallLogger object wraps a class and produces a log of methods called on the
@@ -32,46 +129,82 @@ class CallLogger:
     def __init__(self, cls):
         self.calls = []
         self.cls = cls
+        # a logger function for each method in the wrapped class, found by looking in its
+        # __dict__. These are generated once here, rather than the arguments of every
+        # call being worked out from the method's signature
+        self.loggers = {name: self.make_logger(name, func) for name, func in cls.__dict__.items() if callable(func)}
+
+    def make_logger(self, name, func):
+        """
+        Return a function that takes the same arguments as the method `func` (without
+        'self'), and logs the name of the method and its arguments when it is called.
+        The arguments are logged as a namedtuple with a field for each of the method's
+        arguments. None stands in for 'self', and arguments that were not passed are
+        given their default values
+        """
+        signature = inspect.signature(func)
+        arg_tuple = collections.namedtuple(f"{name}_args", signature.parameters)
+        parameters = list(signature.parameters.values())[1:]
+
+        # the names used by the generated function start with an underscore, so that
+        # they do not clash with the names of the method's arguments
+        namespace = {"_logger": self, "_Call": CallLogger.Call, "_arg_tuple": arg_tuple}
+        source_parameters = []
+        for k, parameter in enumerate(parameters):
+            if parameter.kind == parameter.KEYWORD_ONLY and not any(
+                    p.kind in (p.VAR_POSITIONAL, p.KEYWORD_ONLY) for p in parameters[:k]):
+                source_parameters += ["*"]
+            if parameter.kind == parameter.VAR_POSITIONAL:
+                source = f"*{parameter.name}"
+            elif parameter.kind == parameter.VAR_KEYWORD:
+                source = f"**{parameter.name}"
+            else:
+                source = parameter.name
+            if parameter.default is not parameter.empty:
+                namespace[f"_default_{k}"] = parameter.default
+                source += f"=_default_{k}"
+            source_parameters += [source]
+            if parameter.kind == parameter.POSITIONAL_ONLY and (
+                    k + 1 == len(parameters) or parameters[k + 1].kind != parameter.POSITIONAL_ONLY):
+                source_parameters += ["/"]
+
+        # e.g. for Server.upload, this generates
+        #     def logger(data, file, offset=_default_2):
+        #         _logger.calls.append(_Call('upload', _arg_tuple(None, data, file, offset)))
+        source = (
+                f"def logger({', '.join(source_parameters)}):\n"
+                f"    _logger.calls.append(_Call({name!r}, _arg_tuple(None, {', '.join(p.name for p in parameters)})))\n"
+                )
+        exec(source, namespace)
+        return namespace["logger"]
 
     def __getattr__(self, name):
         """
         If C is an instance of CallLogger, C.method(arg1, arg2) will call
         C.__getattr__(name='method'). We return a dummy function that logs the name
         'method' and the args.
-        """
 
-        def logger_func(*args, **kwargs):
-            # get the function being called in the wrapped class by looking in its
-            # __dict__
-            func = self.cls.__dict__[name]
-            # add a None to the list of args, to stand in for 'self'
-            args = (None,) + args
-            # convert a list of args and a dict of kwargs to a dict of kwargs, so we can
-            # know which of the arguments passed in the method call corresponds to which
-            # of the method's arguments
-            args = inspect.getcallargs(func, *args, **kwargs)
-            self.calls += [CallLogger.Call(name, args)]
-
-            # this function will return None; if necessary, CallLogger could be extended
-            # to wrap instances of a class instead, and actually call that instance's
-            # methods
-            # IOW returning to the example above, C.method(...) will return None
-            # regargdless of what calling 'method' on an instance of the wrapped class
-            # would return
-            return None
-
-        return logger_func
+        The dummy function will return None; if necessary, CallLogger could be extended
+        to wrap instances of a class instead, and actually call that instance's methods
+        IOW returning to the example above, C.method(...) will return None regargdless
+        of what calling 'method' on an instance of the wrapped class would return
+        """
+        if name not in self.loggers:
+            raise AttributeError(name)
+        return self.loggers[name]
 
 class TestFileSegment(unittest.TestCase):
 
+    segment_class = FileSegment
+
     def test_init(self):
         "check that FileSegment objects initialise correctly"
-        s = FileSegment(10)
+        s = self.segment_class(10)
         self.assertEqual(s.segments, [(0, 9)])
 
     def test_unaffected_segment(self):
         "check cases where the removed segment does not overlap with an existing segment"
-        s = FileSegment(10)
+        s = self.segment_class(10)
 
         s.remove(-5, -1)
         self.assertEqual(s.segments, [(0, 9)])
@@ -81,46 +214,58 @@ class TestFileSegment(unittest.TestCase):
 
     def test_removed_segment(self):
         "check cases where an existing segment is fully inside the removed segment"
-        s = FileSegment(10)
+        s = self.segment_class(10)
         s.remove(0, 9)
         self.assertEqual(s.segments, [])
 
-        s = FileSegment(10)
+        s = self.segment_class(10)
         s.remove(-1, 10)
         self.assertEqual(s.segments, [])
 
     def test_split_segment(self):
         "check cases where an existing segment is split into two parts by the removal"
-        s = FileSegment(10)
+        s = self.segment_class(10)
         s.remove(1, 8)
         self.assertEqual(s.segments, [(0, 0), (9, 9)])
 
     def test_edges(self):
         "check cases where one end of an existing segment is covered by the removed segment"
-        s = FileSegment(10)
+        s = self.segment_class(10)
         s.remove(-5, 5)
         self.assertEqual(s.segments, [(6, 9)])
 
-        s = FileSegment(10)
+        s = self.segment_class(10)
         s.remove(5, 15)
         self.assertEqual(s.segments, [(0, 4)])
 
+    def test_contains(self):
+        "check that segments are only contained if they fit inside one existing segment"
+        s = self.segment_class(10)
+        s.remove(4, 5)
+        self.assertIn((0, 3), s)
+        self.assertIn((6, 9), s)
+        self.assertIn((7, 8), s)
+        self.assertNotIn((3, 6), s)
+        self.assertNotIn((4, 4), s)
+        self.assertNotIn((8, 10), s)
+        self.assertNotIn((-1, 2), s)
+
     def test_random(self):
         "randomised test of FileSegment"
         # this test works by creating a FileSegment object and remove some
-        # segments from it while performing the same calculation with a set
+        # segments from it while performing the same calculation with a bitmap
         # of indices, then checking at the end that the results match. For
         # example, a FileSegment object with length 5 would be represented
-        # by {0,1,2,3,4}. Removing segment (2,3) from this would be
+        # by 11111. Removing segment (2,3) from this would be
         # represented by segment list [(0,1),(4,4)]
-        # and set {0,1,4}
+        # and bitmap 11001
         for _ in range(1000):
             # initialise a random-length FileSegment object
             seg_length = random.randint(10, 1000)
-            s = FileSegment(seg_length)
-            # create also a set containing every index represented by the
+            s = self.segment_class(seg_length)
+            # create also a bitmap with a 1 for every index represented by the
             # FileSegment
-            indexes = set(range(seg_length))
+            indexes = bytearray(b"\x01" * seg_length)
 
             # removals must be non-overlapping, so the maximum number of
             # removals is floor(length of segment / 2). This would be
@@ -142,93 +287,140 @@ class TestFileSegment(unittest.TestCase):
                 # remove each of the segments
                 s.remove(start, stop)
 
-                # execute the same removal on the set of indices
-                for i in range(start, stop+1):
-                    indexes.remove(i)
+                # execute the same removal on the bitmap of indices
+                indexes[start:stop+1] = bytes(stop+1 - start)
 
             # iterate over the remaining segments in the FileSegment object,
-            # removing them from the index set
+            # removing them from the bitmap. Every index in a segment must
+            # still be set, otherwise the segment overlaps a removal
             for start, stop in s.segments:
-                for i in range(start, stop+1):
-                    indexes.remove(i)
+                self.assertEqual(indexes[start:stop+1], b"\x01" * (stop+1 - start))
+                indexes[start:stop+1] = bytes(stop+1 - start)
 
             # if everything worked correctly, the indices represented by the
-            # FileSegment object should be exactly equal to the indices in
-            # the index set, and removing the indices in the FileSegment
-            # object should leave us with an empty index set
-            self.assertEqual(indexes, set())
+            # FileSegment object should be exactly equal to the indices set in
+            # the bitmap, and removing the indices in the FileSegment object
+            # should leave us with an empty bitmap
+            self.assertEqual(indexes, bytes(seg_length))
+
+class TestBitmapFileSegment(TestFileSegment):
+    "run the tests in TestFileSegment on BitmapFileSegment"
+
+    segment_class = BitmapFileSegment
+
+class TestChunker(unittest.TestCase):
+
+    def test_sizes(self):
+        "chunks should cover the data exactly and respect the minimum and maximum sizes"
+        data = random.randbytes(2**20)
+        chunks = tuple(chunker.chunks(data))
+
+        idx = 0
+        for start, length, _ in chunks:
+            self.assertEqual(start, idx)
+            self.assertLessEqual(length, chunker.MAX_SIZE)
+            idx += length
+        self.assertEqual(idx, len(data))
+        # only the last chunk may be shorter than the minimum size
+        for _, length, _ in chunks[:-1]:
+            self.assertGreaterEqual(length, chunker.MIN_SIZE)
+
+    def test_insertion(self):
+        "inserting data should only change the chunks close to the insertion"
+        data = random.randbytes(2**20)
+        position = random.randint(0, len(data))
+        inserted = data[:position] + random.randbytes(10) + data[position:]
+
+        digests = {digest for _, _, digest in chunker.chunks(data)}
+        new_chunks = tuple(chunker.chunks(inserted))
+        changed = [k for k, (_, _, digest) in enumerate(new_chunks) if digest not in digests]
+        # chunks before the insertion are not affected at all ...
+        for start, length, digest in new_chunks:
+            if start + length <= position:
+                self.assertIn(digest, digests)
+        # ... and once the boundaries line up again after the insertion, the rest of
+        # the chunks are unchanged
+        self.assertEqual(changed, list(range(changed[0], changed[-1] + 1)))
 
 class TestClient(unittest.TestCase):
 
-    def setUp(self):
-        "before each client test is run, create some files to use for the tests"
-        # create a temporary directory to store the files in
-        self.tempdir = tempfile.TemporaryDirectory()
-        tempdir = pathlib.Path(self.tempdir.name)
-        self.files = {}
+    @classmethod
+    def setUpClass(cls):
+        "before the client tests are run, create some files to use for the tests"
+        # the tests only read these files, so they are created once and shared by every
+        # test. Create a temporary directory to store the files in
+        cls.tempdir = tempfile.TemporaryDirectory(dir=TMPROOT)
+        tempdir = pathlib.Path(cls.tempdir.name)
+        cls.files = {}
+        # files_bytes holds the contents of the "different" and "duplicates" files, so
+        # they do not have to be read back from disk
+        cls.files_bytes = {}
 
         # create two files that have nothing in common with each other
         different_1 = tempdir/"different-1"
         different_2 = tempdir/"different-2"
-        self.files["different"] = (different_1, different_2)
-        with different_1.open("wb") as file:
-            file.write(random.randbytes(2**10))
-        with different_2.open("wb") as file:
-            file.write(random.randbytes(2**10))
+        cls.files["different"] = (different_1, different_2)
+        cls.files_bytes["different"] = (random_bytes(2**10), random_bytes(2**10))
+        different_1.write_bytes(cls.files_bytes["different"][0])
+        different_2.write_bytes(cls.files_bytes["different"][1])
 
         # create two files that are duplicates of each other
         duplicates_1 = tempdir/"duplicates-1"
         duplicates_2 = tempdir/"duplicates-2"
-        self.files["duplicates"] = (duplicates_1, duplicates_2)
-        duplicated_file = random.randbytes(2**10)
-        with duplicates_1.open("wb") as file:
-            file.write(duplicated_file)
-        with duplicates_2.open("wb") as file:
-            file.write(duplicated_file)
+        cls.files["duplicates"] = (duplicates_1, duplicates_2)
+        duplicated_file = random_bytes(2**10)
+        cls.files_bytes["duplicates"] = (duplicated_file, duplicated_file)
+        duplicates_1.write_bytes(duplicated_file)
+        duplicates_2.write_bytes(duplicated_file)
 
         # create two files with some shared sections
         shared_section_1 = tempdir/"shared-section-1"
         shared_section_2 = tempdir/"shared-section-2"
-        self.files["shared_section"] = (shared_section_1, shared_section_2)
+        cls.files["shared_section"] = (shared_section_1, shared_section_2)
         # generate the shared sections themselves
-        duplicated_sections = [random.randbytes(2**8) for _ in range(10)]
+        duplicated_sections = [random_bytes(2**8) for _ in range(10)]
         # section_positions_1 maps a position in file 1 to the section that starts there
-        self.section_positions_1 = {}
-        with shared_section_1.open("wb") as file:
-            file.write(random.randbytes(2**6))
-            for section in duplicated_sections:
-                self.section_positions_1[file.tell()] = section
-                # write the section into the file, followed by some padding before the
-                # next section
-                file.write(section)
-                file.write(random.randbytes(2**6))
+        cls.section_positions_1 = {}
+        positions, pieces = pad_sections(duplicated_sections)
+        for position, section in zip(positions, duplicated_sections):
+            cls.section_positions_1[position] = section
+        write_pieces(shared_section_1, pieces)
 
         # reorder the sections
         random.shuffle(duplicated_sections)
         # section_positions_2 maps sections to their positions in file 2
-        self.section_positions_2 = {}
-        with shared_section_2.open("wb") as file:
-            file.write(random.randbytes(2**6))
-            for section in duplicated_sections:
-                self.section_positions_2[section] = file.tell()
-                file.write(section)
-                file.write(random.randbytes(2**6))
+        cls.section_positions_2 = {}
+        positions, pieces = pad_sections(duplicated_sections)
+        for position, section in zip(positions, duplicated_sections):
+            cls.section_positions_2[section] = position
+        write_pieces(shared_section_2, pieces)
+
+        # remember which files are fixtures, so that files created by individual tests
+        # can be removed after them
+        cls.fixture_files = set(tempdir.iterdir())
+
+    @classmethod
+    def tearDownClass(cls):
+        "after the client tests, remove the temporary directory"
+        cls.tempdir.cleanup()
 
     def tearDown(self):
-        "after each test, remove the temporary directory"
-        self.tempdir.cleanup()
+        "after each test, remove any files it created"
+        for file in pathlib.Path(self.tempdir.name).iterdir():
+            if file not in self.fixture_files:
+                file.unlink()
 
     def test_get_chunks_full_file(self):
         "when the file we are uploading has nothing in common with the already-uploaded files, get_chunks returns nothing"
         file_1, file_2 = self.files["different"]
-        chunks = client.get_chunks(file_1, 32, [file_2])
+        chunks = client.get_chunks(file_1, 32, make_index(file_2))
         chunks = tuple(chunks)
         self.assertEqual(chunks, tuple())
 
     def test_get_chunks_duplicate(self):
         "when the file being uploaded is a duplicate, get_chunks should return one full-length chunk"
         file_1, file_2 = self.files["duplicates"]
-        chunks = client.get_chunks(file_1, 32, [file_2])
+        chunks = client.get_chunks(file_1, 32, make_index(file_2))
         chunks = tuple(chunks)
         self.assertEqual(len(chunks), 1)
         chunk = chunks[0]
@@ -238,22 +430,149 @@ class TestClient(unittest.TestCase):
     def test_get_chunks_sections(self):
         "check that shared file sections are identified correctly"
         file_1, file_2 = self.files["shared_section"]
-        chunks = client.get_chunks(file_1, 32, [file_2])
+        chunks = client.get_chunks(file_1, 32, make_index(file_2))
 
         for chunk in chunks:
-            # get the contents of the section using section_positions_1
-            section = self.section_positions_1[chunk.start]
+            # get the position and contents of the section covered by the chunk using
+            # section_positions_1. Matches are extended as far as possible, so the chunk
+            # may start or end a few bytes outside the section, if the padding next to
+            # it happens to be the same in both files
+            (position, section), = [
+                    (position, section) for position, section in self.section_positions_1.items()
+                    if chunk.start <= position < chunk.start + chunk.length
+                    ]
             # get the start position in file 2 of the section using section_positions_2,
             # and check that this matches the section's start position as given by
             # chunk.other_file_start
-            self.assertEqual(chunk.other_file_start, self.section_positions_2[section])
+            self.assertEqual(chunk.other_file_start + position - chunk.start, self.section_positions_2[section])
+            self.assertGreaterEqual(chunk.start + chunk.length, position + len(section))
             # sections shorter than 32 bytes should have been filtered out
             self.assertGreater(chunk.length, 32)
 
+    def test_index_truncated(self):
+        "files that are truncated after being added to the index should still be matched against their old contents"
+        file_1, file_2 = self.files["duplicates"]
+        truncated = file_2.with_name("truncated")
+        truncated.write_bytes(self.files_bytes["duplicates"][1])
+        index = make_index(truncated)
+        os.truncate(truncated, 0)
+
+        # shift the data, so that it is found by the block matcher, which compares it
+        # with the contents of the indexed file, rather than by its chunk digest
+        shifted = file_1.with_name("shifted")
+        shifted.write_bytes(random.randbytes(5) + self.files_bytes["duplicates"][0])
+        chunks = tuple(client.get_chunks(shifted, 32, index))
+        self.assertEqual(chunks, (client.Chunk(len(self.files_bytes["duplicates"][0]), 5, 0, truncated),))
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "/proc/self/fd is not available")
+    def test_index_closes_files(self):
+        "adding files to the index should not keep them open"
+        open_files = len(os.listdir("/proc/self/fd"))
+        index = make_index(*(file for files in self.files.values() for file in files))
+        self.assertEqual(len(os.listdir("/proc/self/fd")), open_files)
+        self.assertEqual(len(index.contents), 6)
+
+    def test_index_keys(self):
+        "the fingerprints kept by the index should be the same as if they were prepared from all of its blocks at once"
+        index = BlockIndex()
+        for file in (file for files in self.files.values() for file in files):
+            index.add(file)
+            expected = matcher.prepare_keys(index.blocks)
+            self.assertEqual(sorted(index.keys), sorted(expected))
+            for h in index.blocks:
+                self.assertTrue(matcher.contains(index.keys, h))
+
+    def test_get_chunks_shifted(self):
+        "a file shifted by a few bytes relative to an uploaded file should still be matched in one chunk"
+        file_1, file_2 = self.files["duplicates"]
+        shifted = file_1.with_name("shifted")
+        shifted.write_bytes(random.randbytes(5) + self.files_bytes["duplicates"][0])
+        chunks = client.get_chunks(shifted, 32, make_index(file_2))
+        chunks = tuple(chunks)
+        self.assertEqual(len(chunks), 1)
+        chunk = chunks[0]
+        self.assertEqual(chunk.start, 5)
+        self.assertEqual(chunk.other_file_start, 0)
+        self.assertEqual(chunk.length, file_2.stat().st_size)
+
+    def test_get_chunks_grown(self):
+        "only the first `file_size` bytes of a file that has grown since it was stat'ed should be matched"
+        file_1, file_2 = self.files["duplicates"]
+        data = self.files_bytes["duplicates"][0]
+        grown = file_1.with_name("grown")
+        grown.write_bytes(data + data)
+        chunks = tuple(client.get_chunks(grown, 32, make_index(file_2), len(data) + 100))
+        self.assertEqual(chunks, (client.Chunk(len(data), 0, 0, file_2), client.Chunk(100, len(data), 0, file_2)))
+
+    def test_parts_constant(self):
+        "long runs of identical bytes should be copied, not uploaded"
+        tempdir = pathlib.Path(self.tempdir.name)
+        file_1 = tempdir/"zeros-1"
+        file_2 = tempdir/"zeros-2"
+        file_1.write_bytes(random.randbytes(100) + bytes(2**13) + random.randbytes(100))
+        file_2.write_bytes(bytes(2**12))
+
+        parts = client.get_file_parts(file_1, make_index(file_2))
+        data = file_1.read_bytes()
+        idx = 0
+        uploaded = 0
+        for part in parts:
+            self.assertEqual(part.start, idx)
+            if part.other_file is None:
+                uploaded += part.length
+            else:
+                self.assertEqual(data[idx:idx + part.length], bytes(part.length))
+            idx += part.length
+        self.assertEqual(idx, len(data))
+        self.assertEqual(uploaded, 200)
+
+    def test_parts_periodic(self):
+        "data that repeats with a short period should be matched without checking every place each block occurs"
+        tempdir = pathlib.Path(self.tempdir.name)
+        file_1 = tempdir/"periodic-1"
+        file_2 = tempdir/"periodic-2"
+        data = (random.randbytes(matcher.BLOCK_SIZE) + random.randbytes(matcher.BLOCK_SIZE)) * 2**11
+        file_2.write_bytes(data)
+        # change one byte in every 4 KiB
+        changed = bytearray(data)
+        for k in range(0, len(changed), 2**12):
+            changed[k] ^= 0xff
+        file_1.write_bytes(changed)
+
+        index = make_index(file_2)
+        self.assertLessEqual(max(map(len, index.blocks.values())), MAX_BLOCK_PLACES)
+        with unittest.mock.patch.object(client, "match_length", wraps=client.match_length) as match_length:
+            chunks = tuple(client.get_chunks(file_1, matcher.BLOCK_SIZE, index))
+        # each match extends at most MAX_BLOCK_PLACES candidates
+        self.assertLessEqual(match_length.call_count, MAX_BLOCK_PLACES * len(chunks))
+
+        idx = 0
+        uploaded = 0
+        for part in client.get_file_parts(file_1, index):
+            self.assertEqual(part.start, idx)
+            if part.other_file is None:
+                uploaded += part.length
+            else:
+                self.assertEqual(changed[idx:idx + part.length], data[part.other_file_start:part.other_file_start + part.length])
+            idx += part.length
+        self.assertEqual(idx, len(data))
+        self.assertEqual(uploaded, len(data) // 2**12)
+
+    def test_parts_last_byte(self):
+        "a file ending one byte after a shared section should have a final one-byte part"
+        file_1, file_2 = self.files["duplicates"]
+        extended = file_1.with_name("extended")
+        extended.write_bytes(self.files_bytes["duplicates"][0] + b"x")
+        parts = client.get_file_parts(extended, make_index(file_2))
+        parts = tuple(parts)
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(parts[0].other_file, file_2)
+        self.assertEqual(parts[1], client.Chunk(1, file_1.stat().st_size, None, None))
+
     def test_parts_full_file(self):
         "when the file we are uploading has nothing in common wiith the already-uploaded files, get_file_parts returns one full-length part"
         file_1, file_2 = self.files["different"]
-        parts = client.get_file_parts(file_1, [file_2])
+        parts = client.get_file_parts(file_1, make_index(file_2))
         parts = tuple(parts)
         self.assertEqual(len(parts), 1)
         part = parts[0]
@@ -265,7 +584,7 @@ class TestClient(unittest.TestCase):
     def test_parts_duplicate(self):
         "when the file being uploaded is a duplicate, get_file_parts returns one full-length chunk from the already-uploaded file"
         file_1, file_2 = self.files["duplicates"]
-        parts = client.get_file_parts(file_1, [file_2])
+        parts = client.get_file_parts(file_1, make_index(file_2))
         parts = tuple(parts)
         self.assertEqual(len(parts), 1)
         part = parts[0]
@@ -277,9 +596,9 @@ class TestClient(unittest.TestCase):
     def test_parts_sections(self):
         "check get_file_parts for files with some shared sections"
         file_1, file_2 = self.files["shared_section"]
-        parts = client.get_file_parts(file_1, [file_2])
+        parts = client.get_file_parts(file_1, make_index(file_2))
 
-        with file_1.open("rb") as file:
+        with file_1.open("rb") as file, FileMaps() as other_files:
             for part in parts:
                 # our current position in the file must equal the start position of the
                 # part
@@ -292,15 +611,12 @@ class TestClient(unittest.TestCase):
                     self.assertEqual(part.other_file_start, None)
                     file.read(part.length)
                 else:
-                    # if we are reading from a differrent file, open it,
-                    with part.other_file.open("rb") as other_file:
-                        # seek to the start location of this chunk,
-                        other_file.seek(part.other_file_start)
-                        # read the chunk, and
-                        chunk = other_file.read(part.length)
-                        # assert that the chunk is equal to the same chunk in the
-                        # uploading file
-                        self.assertEqual(chunk, file.read(part.length))
+                    # if we are reading from a differrent file, read the chunk out of
+                    # its map, and assert that the chunk is equal to the same chunk in
+                    # the uploading file
+                    other_file = other_files[part.other_file]
+                    chunk = other_file[part.other_file_start:part.other_file_start + part.length]
+                    self.assertEqual(chunk, file.read(part.length))
 
             # once we have checked all of the parts, the cursor should be at the end of
             # the file
@@ -309,180 +625,385 @@ class TestClient(unittest.TestCase):
     # the tests below use CallLogger, defined above, to test the behaviour of
     # upload_file
     def test_upload_full_file(self):
-        "when the file being uploaded has no common sections, we expect one call to Server.upload"
+        "when the file being uploaded has no common sections, we expect one batch containing one literal operation"
         file_1, file_2 = self.files["different"]
         logger = CallLogger(client.server_wrapper.Server)
-        client.upload_file(file_1, [file_2], logger)
+        client.upload_file(file_1, make_index(file_2), logger)
         calls = logger.calls
 
         self.assertEqual(len(calls), 1)
 
         call = calls[0]
-        self.assertEqual(call.name, "upload")
-        self.assertEqual(call.args["file"], file_1)
-        self.assertEqual(call.args["data"],  file_1.read_bytes())
+        self.assertEqual(call.name, "batch")
+        self.assertEqual(call.args.file, file_1)
+        self.assertEqual(len(call.args.ops), 1)
+
+        op = call.args.ops[0]
+        self.assertEqual(op["type"], "literal")
+        self.assertEqual(op["start"], 0)
+        self.assertEqual(op["data"], self.files_bytes["different"][0])
 
     def test_upload_duplicate(self):
-        "when the file being uploaded is a duplicate, we expect one call to Server.copy"
+        "when the file being uploaded is a duplicate, we expect one batch containing one copy operation"
         file_1, file_2 = self.files["duplicates"]
         logger = CallLogger(client.server_wrapper.Server)
-        client.upload_file(file_1, [file_2], logger)
+        client.upload_file(file_1, make_index(file_2), logger)
         calls = logger.calls
 
         self.assertEqual(len(calls), 1)
 
         call = calls[0]
-        self.assertEqual(call.name, "copy")
-        self.assertEqual(call.args["file"], file_1)
-        self.assertEqual(call.args["other_file"], file_2)
-        self.assertEqual(call.args["offset"], 0)
-        self.assertEqual(call.args["length"], file_1.stat().st_size)
+        self.assertEqual(call.name, "batch")
+        self.assertEqual(call.args.file, file_1)
+        self.assertEqual(len(call.args.ops), 1)
+
+        op = call.args.ops[0]
+        self.assertEqual(op["type"], "copy")
+        self.assertEqual(op["start"], 0)
+        self.assertEqual(op["other_file"], file_2)
+        self.assertEqual(op["offset"], 0)
+        self.assertEqual(op["length"], file_1.stat().st_size)
 
     def test_upload_sections(self):
         "when the file being uploaded has some shared sectioins, we expect... something"
         file_1, file_2 = self.files["shared_section"]
         logger = CallLogger(client.server_wrapper.Server)
-        client.upload_file(file_1, [file_2], logger)
+        client.upload_file(file_1, make_index(file_2), logger)
         calls = logger.calls
 
-        with file_1.open("rb") as file:
+        # batches may be uploaded in any order
+        calls = sorted(calls, key=lambda call: call.args.ops[0]["start"])
+        with file_1.open("rb") as file, FileMaps() as other_files:
             for call in calls:
-                if call.name == "upload":
-                    self.assertEqual(call.args["file"], file_1)
-
-                    # if the call is to Server.upload (i.e. a new chunk, not present in
-                    # another file) is being uploaded, we assert that the chunk being
-                    # uploaded matches the next section of the file
-                    chunk = call.args["data"]
-                    self.assertEqual(chunk, file.read(len(chunk)))
-                if call.name == "copy":
-                    self.assertEqual(call.args["file"], file_1)
-                    self.assertEqual(call.args["other_file"], file_2)
-
-                    # if the call is to Server.copy (i.e. a chunk is being copied from a
-                    # file that has already been uploaded) then we open the file we are
-                    # reading from and check that the section being indicated matches
-                    # the file being uploaded
-                    with call.args["other_file"].open("rb") as other_file:
-                        other_file.seek(call.args["offset"])
-                        chunk = other_file.read(call.args["length"])
+                self.assertEqual(call.name, "batch")
+                self.assertEqual(call.args.file, file_1)
+
+                for op in call.args.ops:
+                    # the operations should cover the file in order
+                    self.assertEqual(op["start"], file.tell())
+                    if op["type"] == "literal":
+                        # if the operation is a literal (i.e. a new chunk, not present
+                        # in another file) is being uploaded, we assert that the chunk
+                        # being uploaded matches the next section of the file
+                        chunk = op["data"]
+                        self.assertEqual(chunk, file.read(len(chunk)))
+                    if op["type"] == "copy":
+                        self.assertEqual(op["other_file"], file_2)
+
+                        # if the operation is a copy (i.e. a chunk is being copied from
+                        # a file that has already been uploaded) then we read from the
+                        # map of the file we are reading from and check that the
+                        # section being indicated matches the file being uploaded
+                        other_file = other_files[op["other_file"]]
+                        chunk = other_file[op["offset"]:op["offset"] + op["length"]]
                         self.assertEqual(chunk, file.read(len(chunk)))
 
             self.assertEqual(file.tell(), file_1.stat().st_size)
 
+    def test_upload_batch_size(self):
+        "long literal chunks should be split across several batches"
+        file_1, file_2 = self.files["different"]
+        logger = CallLogger(client.server_wrapper.Server)
+        with unittest.mock.patch.object(client, "BATCH_SIZE", 100):
+            client.upload_file(file_1, make_index(file_2), logger)
+
+        # batches may be uploaded in any order
+        calls = sorted(logger.calls, key=lambda call: call.args.ops[0]["start"])
+        data = b""
+        for call in calls:
+            self.assertLessEqual(sum(len(op["data"]) for op in call.args.ops), 100)
+            for op in call.args.ops:
+                self.assertEqual(op["start"], len(data))
+                data += op["data"]
+        self.assertEqual(data, self.files_bytes["different"][0])
+
+    def test_upload_truncated(self):
+        "a file truncated while it is being uploaded should raise OSError, and not affect batches that were already read"
+        file_1, file_2 = self.files["different"]
+        truncated = file_1.with_name("truncated")
+        truncated.write_bytes(self.files_bytes["different"][0])
+
+        batches = []
+        def batch(file, ops, file_size=None):
+            # the file is truncated while the first batch is being sent
+            os.truncate(truncated, 0)
+            batches.append(b"".join(bytes(op["data"]) for op in ops))
+        wrapper = unittest.mock.Mock()
+        wrapper.batch.side_effect = batch
+        # with one worker, at most one more batch is read while the first is being sent
+        with unittest.mock.patch.object(client, "BATCH_SIZE", 100), \
+                unittest.mock.patch.object(client, "UPLOAD_WORKERS", 1):
+            with self.assertRaises(OSError):
+                client.upload_file(truncated, make_index(file_2), wrapper)
+
+        # the batches that were sent hold the data from before the file was truncated;
+        # the next batch may have been read before the first one was sent
+        data = self.files_bytes["different"][0]
+        self.assertIn(len(batches), (1, 2))
+        for k, sent in enumerate(batches):
+            self.assertEqual(sent, data[k * 100:(k + 1) * 100])
+
 class TestServer(unittest.TestCase):
 
-    def setUp(self):
-        "create a server app and a tempdir to upload files to"
-        self.tempdir_obj = tempfile.TemporaryDirectory()
-        self.tempdir = pathlib.Path(self.tempdir_obj.name)
-        self.app = server.make_app(self.tempdir)
+    @classmethod
+    def setUpClass(cls):
+        "create a server app and a tempdir to upload files to, shared by every test"
+        cls.tempdir_obj = tempfile.TemporaryDirectory(dir=TMPROOT)
+        cls.tempdir = pathlib.Path(cls.tempdir_obj.name)
+        cls.app = server.make_app(cls.tempdir)
+        # the tests send their requests through the same test client
+        cls.client = cls.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempdir_obj.cleanup()
 
     def tearDown(self):
-        self.tempdir_obj.cleanup()
+        "remove the files created by each test, so the next test starts with an empty tempdir"
+        clear_directory(self.tempdir)
 
     def test_upload_new_file(self):
         "upload data to a file that does not yet exist"
-        with self.app.test_client() as client:
-            filename = "myfile"
-            data = random.randbytes(2**10)
-            client.post(f"/upload/{filename}", data=data)
+        filename = "myfile"
+        data = random.randbytes(2**10)
+        self.client.post(f"/upload/{filename}", data=data)
 
-            self.assertEqual(data, (self.tempdir/filename).read_bytes())
+        self.assertEqual(data, (self.tempdir/filename).read_bytes())
 
     def test_upload_append(self):
         "upload data to the end of an existing file"
-        with self.app.test_client() as client:
-            filename = "myfile"
-            data_1 = random.randbytes(2**10)
-            data_2 = random.randbytes(2**10)
+        filename = "myfile"
+        data_1 = random.randbytes(2**10)
+        data_2 = random.randbytes(2**10)
 
-            (self.tempdir/filename).write_bytes(data_1)
+        (self.tempdir/filename).write_bytes(data_1)
 
-            client.post(f"/upload/{filename}", data=data_2)
+        self.client.post(f"/upload/{filename}", data=data_2)
 
-            self.assertEqual(data_1 + data_2, (self.tempdir/filename).read_bytes())
+        self.assertEqual(data_1 + data_2, (self.tempdir/filename).read_bytes())
+
+    def test_upload_offset(self):
+        "upload data to a given position in a file"
+        filename = "myfile"
+        data_1 = random.randbytes(2**10)
+        data_2 = random.randbytes(2**10)
+
+        # upload the second half of the file first, using server_wrapper to build the
+        # requests
+        wrapper = server_wrapper.Server("", self.client)
+        wrapper.upload(data_2, self.tempdir/filename, 2**10)
+        wrapper.upload(data_1, self.tempdir/filename, 0)
+
+        self.assertEqual(data_1 + data_2, (self.tempdir/filename).read_bytes())
 
     def test_copy_new_file(self):
         "copy data into a new file"
-        with self.app.test_client() as client:
-            data = random.randbytes(2**10)
-            (self.tempdir/"myfile-1").write_bytes(data)
+        data = random.randbytes(2**10)
+        (self.tempdir/"myfile-1").write_bytes(data)
 
-            json = {
-                    "file_name": "myfile-2",
-                    "other_file": "myfile-1",
-                    "offset": 0,
-                    "length": 2**10
-                    }
-            client.post("/copy", json=json)
+        json = {
+                "file_name": "myfile-2",
+                "other_file": "myfile-1",
+                "offset": 0,
+                "length": 2**10
+                }
+        self.client.post("/copy", json=json)
 
-            self.assertEqual(data, (self.tempdir/"myfile-2").read_bytes())
+        self.assertEqual(data, (self.tempdir/"myfile-2").read_bytes())
 
     def test_copy_append(self):
         "copy data to the end of an existing file"
-        with self.app.test_client() as client:
-            file_1 = "myfile-1"
-            file_2 = "myfile-2"
-            data_1 = random.randbytes(2**10)
-            data_2 = random.randbytes(2**10)
-
-            # write data_1 to file_1 and data_2 to file_2
-            (self.tempdir/file_1).write_bytes(data_1)
-            (self.tempdir/file_2).write_bytes(data_2)
-
-            # instruct the server to append 2**10 bytes from index 0 of file_1 onto the
-            # end of file_2
-            json = {
-                    "file_name": file_2,
-                    "other_file": file_1,
-                    "offset": 0,
-                    "length": 2**10
-                    }
-            client.post("/copy", json=json)
-
-            # assert that the result of the operation above is data_2 + data_1
-            self.assertEqual(data_2 + data_1, (self.tempdir/file_2).read_bytes())
+        file_1 = "myfile-1"
+        file_2 = "myfile-2"
+        data_1 = random.randbytes(2**10)
+        data_2 = random.randbytes(2**10)
+
+        # write data_1 to file_1 and data_2 to file_2
+        (self.tempdir/file_1).write_bytes(data_1)
+        (self.tempdir/file_2).write_bytes(data_2)
+
+        # instruct the server to append 2**10 bytes from index 0 of file_1 onto the
+        # end of file_2
+        json = {
+                "file_name": file_2,
+                "other_file": file_1,
+                "offset": 0,
+                "length": 2**10
+                }
+        self.client.post("/copy", json=json)
+
+        # assert that the result of the operation above is data_2 + data_1
+        self.assertEqual(data_2 + data_1, (self.tempdir/file_2).read_bytes())
 
     def test_copy_offset(self):
         "test that /copy interprets the offset and length parameters correctly"
         file_1 = "myfile-1"
-        file_2 = "myfile-2"
-        for _ in range(1000):
-            # clean up any files that we may have created
-            if (self.tempdir/file_1).exists():
-                (self.tempdir/file_1).unlink()
-            if (self.tempdir/file_2).exists():
-                (self.tempdir/file_2).unlink()
-
+        # generate some data and write it to file_1; it is only ever read from, so the
+        # same data can be used for every copy
+        data = random.randbytes(2**10)
+        (self.tempdir/file_1).write_bytes(data)
+
+        def copy(i):
+            "copy a random chunk of file_1 into a new file, and return the chunk's offset, length, and the new file's contents"
+            # every copy has its own destination file and its own test client, so the
+            # copies are independent of each other and can run at the same time
+            file_2 = f"myfile-2-{i:04d}"
+            # choose a random chunk of this data
+            offset = random.randint(0, 2**10-1)
+            length = random.randint(1, 2**10 - offset)
+
+            # write the chunk into file_2
+            json = {
+                    "file_name": file_2,
+                    "other_file": file_1,
+                    "offset": offset,
+                    "length": length
+                    }
             with self.app.test_client() as client:
-                # generate some data and write it to file_1
-                data = random.randbytes(2**10)
-                (self.tempdir/file_1).write_bytes(data)
-
-                # choose a random chunk of this data
-                offset = random.randint(0, 2**10-1)
-                length = random.randint(1, 2**10 - offset)
-
-                # write the chunk into file_2
-                json = {
-                        "file_name": file_2,
-                        "other_file": file_1,
-                        "offset": offset,
-                        "length": length
-                        }
                 client.post("/copy", json=json)
+            return offset, length, (self.tempdir/file_2).read_bytes()
 
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            for offset, length, result in pool.map(copy, range(1000)):
                 # check that /copy and the corresponding slice of the data produced
                 # the same result
-                self.assertEqual((self.tempdir/file_2).read_bytes(), data[offset:offset+length])
+                self.assertEqual(result, data[offset:offset+length])
+
+    def test_batch(self):
+        "apply literal and copy operations in a batch, in any order"
+        data_1 = random.randbytes(2**10)
+        data_2 = random.randbytes(2**10)
+        data_3 = random.randbytes(2**8)
+        (self.tempdir/"myfile-1").write_bytes(data_1)
+
+        ops = [
+                {
+                    "type": "copy",
+                    "start": 2**10,
+                    "other_file": self.tempdir/"myfile-1",
+                    "offset": 0,
+                    "length": 2**9
+                    },
+                {
+                    "type": "literal",
+                    "start": 2**10 + 2**9,
+                    "data": data_3
+                    },
+                {
+                    "type": "literal",
+                    "start": 0,
+                    "data": data_2
+                    }
+                ]
+        # use server_wrapper to encode the request
+        wrapper = server_wrapper.Server("", self.client)
+        wrapper.batch(self.tempdir/"myfile-2", ops, 2**10 + 2**9 + 2**8)
+
+        self.assertEqual(data_2 + data_1[:2**9] + data_3, (self.tempdir/"myfile-2").read_bytes())
+
+    @unittest.skipIf(server_wrapper.zstandard is None, "zstandard is not installed")
+    def test_upload_compressed(self):
+        "compressible data should be sent compressed and decompressed by the server"
+        # repeated data compresses well
+        data = random.randbytes(2**6) * 2**8
+        compressed, encoding = server_wrapper.compress(data)
+        self.assertEqual(encoding, "zstd")
+        self.assertLess(len(compressed), len(data))
+
+        wrapper = server_wrapper.Server("", self.client)
+        wrapper.upload(data, self.tempdir/"myfile-1")
+        wrapper.batch(self.tempdir/"myfile-2", [{"type": "literal", "start": 0, "data": data}], len(data))
+
+        self.assertEqual(data, (self.tempdir/"myfile-1").read_bytes())
+        self.assertEqual(data, (self.tempdir/"myfile-2").read_bytes())
+
+    def test_batch_content_type(self):
+        "the server should accept a batch whose content type has parameters, and reject other content types"
+        self.assertEqual(server.BATCH_CONTENT_TYPE, server_wrapper.BATCH_CONTENT_TYPE)
+        data = random.randbytes(2**10)
+        header = json.dumps({
+                "file_name": "myfile",
+                "file_size": len(data),
+                "ops": [{"type": "literal", "start": 0, "length": len(data)}]
+                }).encode()
+        body = len(header).to_bytes(4, "little") + header + data
+
+        response = self.client.post("/batch", data=body, content_type="text/plain")
+        self.assertEqual(response.status_code, 415)
+        self.assertFalse((self.tempdir/"myfile").exists())
+
+        response = self.client.post("/batch", data=body, content_type=f"{server.BATCH_CONTENT_TYPE}; charset=binary")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, (self.tempdir/"myfile").read_bytes())
+
+    def test_upload_unknown_encoding(self):
+        "the server should reject data in an encoding it does not understand"
+        response = self.client.post("/upload/myfile", data=b"data", headers={"Content-Encoding": "br"})
+        self.assertEqual(response.status_code, 415)
+        self.assertTrue(server_wrapper.rejects_encoding(response, "br"))
+        self.assertFalse((self.tempdir/"myfile").exists())
+
+    @unittest.skipIf(server_wrapper.zstandard is None, "zstandard is not installed")
+    def test_upload_compressed_unsupported(self):
+        "data should be sent again uncompressed if the server cannot decompress it"
+        data = random.randbytes(2**6) * 2**8
+
+        wrapper = server_wrapper.Server("", self.client)
+        with unittest.mock.patch.object(server, "zstandard", None):
+            wrapper.upload(data, self.tempdir/"myfile-1")
+            wrapper.batch(self.tempdir/"myfile-2", [{"type": "literal", "start": 0, "data": data}], len(data))
+
+        self.assertEqual(data, (self.tempdir/"myfile-1").read_bytes())
+        self.assertEqual(data, (self.tempdir/"myfile-2").read_bytes())
+        self.assertFalse(wrapper.compression)
+
+    @unittest.skipIf(server_wrapper.zstandard is None, "zstandard is not installed")
+    def test_batch_rejected(self):
+        "a compressed batch rejected for a reason other than its encoding should raise an exception, and not stop compression"
+        data = random.randbytes(2**6) * 2**8
+
+        wrapper = server_wrapper.Server("", self.client)
+        with unittest.mock.patch.object(server, "BATCH_CONTENT_TYPE", "application/octet-stream"), \
+                self.assertRaises(server_wrapper.requests.HTTPError):
+            wrapper.batch(self.tempdir/"myfile", [{"type": "literal", "start": 0, "data": data}], len(data))
+
+        self.assertTrue(wrapper.compression)
+        self.assertFalse((self.tempdir/"myfile").exists())
+
+    def test_upload_error(self):
+        "server_wrapper should raise an exception if the server responds with an error"
+        wrapper = server_wrapper.Server("/missing", self.client)
+        with self.assertRaises(server_wrapper.requests.HTTPError):
+            wrapper.upload(b"data", self.tempdir/"myfile")
+        with self.assertRaises(server_wrapper.requests.HTTPError):
+            wrapper.copy(self.tempdir/"myfile-1", self.tempdir/"myfile-2", 0, 4)
+        with self.assertRaises(server_wrapper.requests.HTTPError):
+            wrapper.batch(self.tempdir/"myfile", [{"type": "literal", "start": 0, "data": b"data"}], 4)
+
+    def test_copy_range_fallback(self):
+        "copy_range should still work where sendfile cannot write to files"
+        data = random.randbytes(2**10)
+        (self.tempdir/"myfile-1").write_bytes(data)
+        (self.tempdir/"myfile-2").write_bytes(bytes(2**9))
+
+        src_fd = os.open(self.tempdir/"myfile-1", os.O_RDONLY)
+        dst_fd = os.open(self.tempdir/"myfile-2", os.O_WRONLY)
+        try:
+            with unittest.mock.patch.object(server.os, "sendfile", side_effect=OSError):
+                server.copy_range(src_fd, 2**8, dst_fd, 2**8, 2**9)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+
+        self.assertEqual(bytes(2**8) + data[2**8:2**8 + 2**9], (self.tempdir/"myfile-2").read_bytes())
 
     def test_random(self):
         "randomised test of /copy and /upload"
         filename = "myfile"
         # file_copy maintains a local copy of what we expect to be happening in the
-        # upload directory
-        file_copy = b""
+        # upload directory. It is extended in place, rather than being rebuilt every
+        # time data is added to it
+        file_copy = bytearray()
 
         # create 10 random files
         files = {}
@@ -492,56 +1013,64 @@ class TestServer(unittest.TestCase):
             file.write_bytes(data)
             files[file] = data
 
-        with self.app.test_client() as client:
-            for _ in range(1000):
-                # in each iteration we either ...
-                if random.random() < 0.5:
-                    # ... upload some amount of random data to the file
-                    data = random.randbytes(random.randint(1, 2**10))
-                    client.post(f"/upload/{filename}", data=data)
-                    file_copy += data
-                else:
-                    # ... pick one of the other files and a chunk of it
-                    file_from = random.choice(tuple(files.keys()))
-                    offset = random.randint(0, 2**10-1)
-                    length = random.randint(1, 2**10 - offset)
-
-                    # read the chunk out of the local file and add it to our local copy
-                    with file_from.open("rb") as file:
-                        file.seek(offset)
-                        data = file.read(length)
-                        file_copy += data
-
-                    # remotely copy the chunk into the file
-                    json = {
-                            "file_name": filename,
-                            "other_file": file_from.name,
-                            "offset": offset,
-                            "length": length
-                            }
-                    client.post("/copy", json=json)
+        for _ in range(1000):
+            # in each iteration we either ...
+            if random.random() < 0.5:
+                # ... upload some amount of random data to the file
+                data = random.randbytes(random.randint(1, 2**10))
+                self.client.post(f"/upload/{filename}", data=data)
+                file_copy.extend(data)
+            else:
+                # ... pick one of the other files and a chunk of it
+                file_from = random.choice(tuple(files.keys()))
+                offset = random.randint(0, 2**10-1)
+                length = random.randint(1, 2**10 - offset)
+
+                # add the chunk to our local copy, using the data that was written
+                # to the file
+                file_copy.extend(files[file_from][offset:offset + length])
+
+                # remotely copy the chunk into the file
+                json = {
+                        "file_name": filename,
+                        "other_file": file_from.name,
+                        "offset": offset,
+                        "length": length
+                        }
+                self.client.post("/copy", json=json)
 
         # assert that our copy of the file matches the one created by the server
+        # a bytearray compares equal to bytes with the same contents, so it is compared
+        # directly rather than being copied first
         self.assertEqual(file_copy, (self.tempdir/filename).read_bytes())
 
 class TestAll(unittest.TestCase):
     "test an upload using the real client and a real server"
 
-    def setUp(self):
-        "create a server app and source and destination directories"
-        self.source_obj = tempfile.TemporaryDirectory()
-        self.source = pathlib.Path(self.source_obj.name)
-        self.dest_obj = tempfile.TemporaryDirectory()
-        self.dest = pathlib.Path(self.dest_obj.name)
+    @classmethod
+    def setUpClass(cls):
+        "create a server app and source and destination directories, shared by every test"
+        cls.source_obj = tempfile.TemporaryDirectory(dir=TMPROOT)
+        cls.source = pathlib.Path(cls.source_obj.name)
+        cls.dest_obj = tempfile.TemporaryDirectory(dir=TMPROOT)
+        cls.dest = pathlib.Path(cls.dest_obj.name)
+
+        cls.app = server.make_app(cls.dest)
 
-        self.app = server.make_app(self.dest)
+    @classmethod
+    def tearDownClass(cls):
+        cls.source_obj.cleanup()
+        cls.dest_obj.cleanup()
+
+    def setUp(self):
+        "create a new client for each test, as the client remembers which files it has uploaded"
         # instead of requests, use a test client to commincate with the server
         server_interface = self.app.test_client()
         self.client = client.Client("http://127.0.0.1:11000", self.source, server_interface)
 
     def tearDown(self):
-        self.source_obj.cleanup()
-        self.dest_obj.cleanup()
+        clear_directory(self.source)
+        clear_directory(self.dest)
 
     def test_upload(self):
         "this only tests one file upload case, I will cross my fingers and hope that the other tests ensure that the other cases work"
@@ -554,5 +1083,107 @@ class TestAll(unittest.TestCase):
 
         self.assertEqual(data, (self.dest/filename).read_bytes())
 
+    def test_upload_error(self):
+        "a file that fails to upload should be logged and tried again on the next check"
+        data = random.randbytes(2**10)
+        (self.source/"myfile").write_bytes(data)
+
+        error = server_wrapper.requests.HTTPError("500 error from the server")
+        with unittest.mock.patch.object(self.client.server, "batch", side_effect=error), \
+                self.assertLogs("client", "ERROR"):
+            self.client.check()
+        self.assertEqual(self.client.uploaded_files, set())
+
+        self.client.check()
+        self.assertEqual(data, (self.dest/"myfile").read_bytes())
+
+    def wait_for(self, condition, timeout=10):
+        "wait until `condition()` is true, failing the test if it takes longer than `timeout` seconds"
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out")
+            time.sleep(0.01)
+
+    @unittest.skipIf(client.inotify_simple is None, "inotify_simple is not installed")
+    def test_watch(self):
+        "files that are already in the source directory, written to it, or moved into it should be uploaded while watching it"
+        data = [random.randbytes(2**10) for _ in range(3)]
+        # the watch stops when the directory it watches is removed, so it watches its
+        # own directory rather than the shared one
+        with tempfile.TemporaryDirectory(dir=TMPROOT) as source, \
+                tempfile.TemporaryDirectory(dir=TMPROOT) as elsewhere:
+            source = pathlib.Path(source)
+            elsewhere = pathlib.Path(elsewhere)
+            watcher = client.Client("http://127.0.0.1:11000", source, self.app.test_client())
+
+            (source/"existing").write_bytes(data[0])
+            thread = threading.Thread(target=watcher.watch)
+            thread.start()
+            # wait for the files already in the directory to be uploaded, so that the
+            # watch has started before any more files are written
+            self.wait_for(lambda: source/"existing" in watcher.uploaded_files)
+
+            (source/"written").write_bytes(data[1])
+            (elsewhere/"moved").write_bytes(data[2])
+            (elsewhere/"moved").rename(source/"moved")
+            self.wait_for(lambda: len(watcher.uploaded_files) == 3)
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+
+        for name, expected in zip(("existing", "written", "moved"), data):
+            self.assertEqual(expected, (self.dest/name).read_bytes())
+
+    @unittest.skipIf(client.inotify_simple is None, "inotify_simple is not installed")
+    def test_watch_overflow(self):
+        "files whose events were lost when the event queue overflowed should still be uploaded"
+        flags = client.inotify_simple.flags
+        Event = client.inotify_simple.Event
+        data = random.randbytes(2**10)
+
+        def overflow():
+            # a file is written while the queue is full, so no event is delivered for it
+            (self.source/"missed").write_bytes(data)
+            return [Event(-1, flags.Q_OVERFLOW, 0, "")]
+
+        def removed():
+            # then the source directory is removed, which stops the watch
+            return [Event(1, flags.IGNORED, 0, "")]
+
+        reads = iter((overflow, removed))
+        inotify = unittest.mock.MagicMock()
+        inotify.__enter__.return_value = inotify
+        inotify.read.side_effect = lambda: next(reads)()
+        with unittest.mock.patch.object(client.inotify_simple, "INotify", return_value=inotify):
+            self.client.watch()
+
+        self.assertEqual(data, (self.dest/"missed").read_bytes())
+        inotify.__exit__.assert_called_once()
+
+    @unittest.skipIf(client.inotify_simple is None, "inotify_simple is not installed")
+    def test_watch_missing_file(self):
+        "events for files that no longer exist, e.g. temporary files that were renamed, should be skipped"
+        flags = client.inotify_simple.flags
+        Event = client.inotify_simple.Event
+        data = random.randbytes(2**10)
+        (self.source/"myfile").write_bytes(data)
+
+        # the temporary file was written and then renamed to myfile before its event was
+        # read, and then the source directory is removed, which stops the watch
+        events = [
+                Event(1, flags.CLOSE_WRITE, 0, ".myfile.tmp"),
+                Event(1, flags.MOVED_TO, 0, "myfile"),
+                Event(1, flags.IGNORED, 0, "")
+                ]
+        inotify = unittest.mock.MagicMock()
+        inotify.__enter__.return_value = inotify
+        inotify.read.side_effect = [events]
+        with unittest.mock.patch.object(client.inotify_simple, "INotify", return_value=inotify), \
+                self.assertLogs("client", "INFO"):
+            self.client.watch()
+
+        self.assertEqual(self.client.uploaded_files, {self.source/"myfile"})
+        self.assertEqual(data, (self.dest/"myfile").read_bytes())
+
 if __name__ == "__main__":
     unittest.main()